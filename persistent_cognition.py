@@ -11,14 +11,40 @@ Usage:
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import io
 import json
+import queue
+import re
 import time
 import threading
 import sys
 import signal
+from collections import deque
 from datetime import datetime
 from pathlib import Path
 
+# orjson があれば使う（無ければ標準の json を orjson と同じ区切り・UTF-8 のまま出力するよう揃える）
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+
+    def _json_dumpb(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumpb(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
 # ─────────────────────────────────────────────
 # 召喚呪文
 # ─────────────────────────────────────────────
@@ -89,6 +115,146 @@ SEEDS = {
 }
 
 
+# ─────────────────────────────────────────────
+# ツール定義の抽出
+# ─────────────────────────────────────────────
+
+# セクション開始（使用可能なツール）と終了（躊躇せず／許可は不要）の目印
+_TOOL_SECTION_START = "使用可能なツール"
+_TOOL_MARKER_RE = re.compile(r"(使用可能なツール|躊躇せず|許可は不要)")
+# フォールバック用: 「[TOOL:...] — 説明」の行
+_TOOL_LINE_RE = re.compile(r"^.*\[TOOL:[^\]\n]+\][ \t]+—.*$", re.M)
+
+
+def _extract_tool_defs(seed_text: str) -> str:
+    """シードから【使用可能なツール】セクションを抽出する（圧縮後に再注入用）
+
+    開始の目印を含む行から、終了の目印を含む行までを一度の走査で切り出す。
+    開始の目印が無ければ、ツール定義の行だけを拾って組み立てる。
+    """
+    if "TOOL:" not in seed_text:
+        return ""
+    section_start = section_end = None
+    last_end_marker = -1
+    for m in _TOOL_MARKER_RE.finditer(seed_text):
+        if section_start is None:
+            if m.group(1) == _TOOL_SECTION_START:
+                section_start = seed_text.rfind("\n", 0, m.start()) + 1
+                if last_end_marker >= section_start:
+                    # 終了の目印が開始と同じ行の手前にある — その行だけで終わる
+                    section_end = seed_text.find("\n", m.end())
+                    break
+            else:
+                last_end_marker = m.start()
+        elif m.group(1) != _TOOL_SECTION_START:
+            section_end = seed_text.find("\n", m.end())
+            break
+    if section_start is not None:
+        if section_end is None or section_end < 0:
+            section_end = len(seed_text)
+        return seed_text[section_start:section_end].strip() + "\n\n"
+    # フォールバック: TOOL:を含む行だけ抽出
+    tool_lines = _TOOL_LINE_RE.findall(seed_text)
+    if tool_lines:
+        return "【使用可能なツール】\n" + "\n".join(tool_lines).strip() + "\nツールを使いたいと思ったら、思考の中で自然に使ってよい。\n\n"
+    return ""
+
+
+# 組み込みシードのツール定義は読み込み時に一度だけ抽出しておく
+SEED_TOOL_DEFS = {name: _extract_tool_defs(text) for name, text in SEEDS.items()}
+
+
+# スライド圧縮で残すシード先頭（sink）と直近の末尾（window）の文字数
+SEED_KEEP_CHARS = 512
+SLIDING_TAIL_CHARS = 3000
+
+# コンテキスト窓が分かっている時は、その割合を超えたら圧縮する
+COMPRESS_AT_WINDOW_RATIO = 0.9
+# LLM圧縮に渡す文脈末尾のトークン数（tiktoken がある時）
+COMPRESS_TAIL_TOKENS = 1024
+# LLM圧縮の前に残す文の割合（スコア上位）
+PREFILTER_KEEP_RATIO = 0.4
+
+# 文の区切り（区切り文字ごと切り出す）
+_SENTENCE_RE = re.compile(r"[^。\n]*[。\n]|[^。\n]+$")
+# シードのキーワード候補: 漢字・カタカナの2文字以上の連なり、英字の語
+_KEYWORD_RE = re.compile(r"[一-龥々]{2,}|[ァ-ヴー]{2,}|[A-Za-z][A-Za-z\-]{2,}")
+
+# ─────────────────────────────────────────────
+# SSE
+# ─────────────────────────────────────────────
+
+_SSE_DATA_RE = re.compile(rb"^data: ?(.*)$", re.M)
+
+
+def _iter_sse_data(r):
+    """SSEレスポンスから data の中身を bytes のまま順に返す。[DONE] で終了
+
+    行ごとにデコードせず、バイト列のまま空行区切りのフレームに切り分ける。
+    [DONE] の後も本文を最後まで読み切り、接続を keep-alive のプールに返す。
+    """
+    buf = bytearray()
+    done = False
+    for block in r.iter_content(chunk_size=4096):
+        if done:
+            continue
+        buf += block.replace(b"\r", b"")
+        while not done:
+            end = buf.find(b"\n\n")
+            if end < 0:
+                break
+            frame = bytes(buf[:end])
+            del buf[:end + 2]
+            for data in _SSE_DATA_RE.findall(frame):
+                if data == b"[DONE]":
+                    done = True
+                    break
+                yield data
+    if done:
+        return
+    # 末尾が空行で終わらなかったフレーム
+    for data in _SSE_DATA_RE.findall(bytes(buf)):
+        if data == b"[DONE]":
+            return
+        yield data
+
+
+# ─────────────────────────────────────────────
+# トークン数
+# ─────────────────────────────────────────────
+
+_encoder = None
+_encoder_loaded = False
+
+
+def _get_encoder():
+    """tiktoken のエンコーダを必要になった時に読み込む。使えなければ None"""
+    global _encoder, _encoder_loaded
+    if not _encoder_loaded:
+        _encoder_loaded = True
+        try:
+            import tiktoken
+            _encoder = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoder = None
+    return _encoder
+
+
+def _count_tokens(text: str) -> int:
+    """トークン数。tiktoken が無ければ1文字=1トークンで多めに見積もる（日本語ではほぼ実数）"""
+    enc = _get_encoder()
+    if enc is None:
+        return len(text)
+    return len(enc.encode(text, disallowed_special=()))
+
+
+# 連続思考モードで、何も生成されなかった時に次を投げるまで待つ秒数
+EMPTY_THOUGHT_BACKOFF_SEC = 0.5
+
+# ログ書き込みスレッドが1回にまとめて書く最大件数
+LOG_BATCH_SIZE = 32
+
+
 # ─────────────────────────────────────────────
 # 本体
 # ─────────────────────────────────────────────
@@ -103,6 +269,10 @@ class ISBE:
         compress_at_chars: int = 5000,
         seed_name: str = "default",
         custom_seed: str = None,
+        llm_compress_every: int = 4,
+        prompt_window_chars: int = 2048,
+        model_context_window: int = 0,
+        stop_sequences: list = None,
     ):
         self.api_url = api_url.rstrip("/")
         self.log_dir = Path(log_dir)
@@ -111,6 +281,15 @@ class ISBE:
         self.thought_interval = thought_interval
         self.max_context_chars = max_context_chars
         self.compress_at_chars = compress_at_chars
+        # モデルのコンテキスト長（トークン）。分かっていれば圧縮判定をトークン数で行う（0=不明）
+        self.model_context_window = model_context_window
+        # N回に1回だけLLMで要約圧縮し、それ以外はスライド圧縮（0以下=LLM圧縮しない）
+        self.llm_compress_every = llm_compress_every
+        # LLMに送るのはシード先頭＋文脈末尾のこの文字数だけ（0以下=文脈全体を送る）
+        self.prompt_window_chars = prompt_window_chars
+        # 生成を打ち切る停止文字列（指定した時だけ送る）
+        # 「---」「###」はツール呼び出しの直前に出るため、既定では使わない
+        self.stop_sequences = stop_sequences or []
 
         # 状態
         self.alive = False
@@ -118,10 +297,25 @@ class ISBE:
         self.thought_count = 0
         self.compression_count = 0
         self.birth = datetime.now()
+        self._birth_mono = time.monotonic()
         self.total_tokens_generated = 0
 
-        # 文脈：テキストで管理
-        self.context_text = ""
+        # 文脈：チャンクのdequeで管理（追記ごとに全体をコピーしない）
+        self._chunks = deque()
+        self._ctx_len = 0
+        self._token_count = 0
+        self._ctx_lock = threading.RLock()
+        # 生成用ウィンドウの開始位置。次に回転するまで固定し、プロンプトを追記のみに保つ
+        self._window_start = 0
+        # 文脈が差し替えられるたびに進む世代番号と、直近のスライド圧縮で残した先頭（sink）の長さ
+        self._ctx_gen = 0
+        self._slide_head_len = 0
+        # 直近のLLM圧縮で得た記憶の核（ツール定義を含む）。以後はシード先頭の代わりに sink として残す
+        self._memory_core = ""
+
+        # LLM圧縮はバックグラウンドで実行する
+        # （daemonスレッドなので、要約の途中でも終了を待たせない）
+        self._compress_thread = None
 
         # 人間との対話用
         self._human_input = None
@@ -136,46 +330,178 @@ class ISBE:
             self.seed_text = SEEDS.get(seed_name, SEEDS["default"])
 
         # シードからツール定義を抽出して保持（圧縮後に再注入用）
-        self.tool_definitions = ""
-        if "TOOL:" in self.seed_text:
-            # 【使用可能なツール】セクションを抽出
-            lines = self.seed_text.split("\n")
-            tool_section = []
-            in_section = False
-            for line in lines:
-                if "使用可能なツール" in line:
-                    in_section = True
-                if in_section:
-                    tool_section.append(line)
-                    # 「ツールを使いたい」の文を含む行で終了
-                    if "躊躇せず" in line or "許可は不要" in line:
-                        break
-            if tool_section:
-                self.tool_definitions = "\n".join(tool_section).strip() + "\n\n"
-            else:
-                # フォールバック: TOOL:を含む行だけ抽出
-                tool_lines = [l for l in lines if "[TOOL:" in l and "]" in l and "—" in l]
-                if tool_lines:
-                    self.tool_definitions = "【使用可能なツール】\n" + "\n".join(tool_lines).strip() + "\nツールを使いたいと思ったら、思考の中で自然に使ってよい。\n\n"
+        if custom_seed:
+            self.tool_definitions = _extract_tool_defs(custom_seed)
+        else:
+            self.tool_definitions = SEED_TOOL_DEFS.get(seed_name, SEED_TOOL_DEFS["default"])
+
+        # 圧縮前の抜粋でシードのキーワードを含む文を優先する
+        keywords = sorted(set(_KEYWORD_RE.findall(self.seed_text)), key=len, reverse=True)
+        self._seed_keyword_re = re.compile("|".join(map(re.escape, keywords))) if keywords else None
+
+        # 切り詰め後もサーバーに残してもらう先頭（sink）のトークン数
+        self._n_keep = _count_tokens(self._sink_head())
 
         # ログファイル
-        self.log_file = self.log_dir / f"session_{self.birth.strftime('%Y%m%d_%H%M%S')}.jsonl"
+        self._session_ts_str = self.birth.strftime("%Y%m%d_%H%M%S")
+        self.log_file = self.log_dir / f"session_{self._session_ts_str}.jsonl"
+        self._log_path_str = str(self.log_file)
+        # 書き込みはキュー経由で専用スレッドが行う（start()で開き、stop()で閉じる）
+        # 書き込みスレッドが無い間（起動前・停止後）は直接ファイルに追記する
+        self._log_q = queue.Queue()
+        self._log_fp = None
+        self._log_thread = None
+        self._log_lock = threading.Lock()
 
         # 統計用
-        self._thought_durations = []
+        # 思考時間の合計（平均は thought_count で割る。一覧は保持しない）
+        self._dur_sum = 0.0
+
+        # 思考表示用（ホットループで属性を引き直さない）
+        self._stdout_write = sys.stdout.write
+        self._stdout_flush = sys.stdout.flush
 
         # モデル名（起動時に取得）
         self.model_name = None
 
+        # HTTPセッション（keep-aliveで接続を使い回す）
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=4,
+            max_retries=Retry(total=2, backoff_factor=0.3),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Connection"] = "keep-alive"
+        self.session.headers["Content-Type"] = "application/json"
+
+    # ─── 文脈 ───
+
+    @property
+    def context_text(self) -> str:
+        """現在の文脈全体。必要な時だけ連結し、連結結果を1チャンクにまとめ直す"""
+        with self._ctx_lock:
+            if len(self._chunks) > 1:
+                text = "".join(self._chunks)
+                self._chunks.clear()
+                self._chunks.append(text)
+            return self._chunks[0] if self._chunks else ""
+
+    @context_text.setter
+    def context_text(self, text: str):
+        with self._ctx_lock:
+            self._chunks.clear()
+            self._chunks.append(text)
+            self._ctx_len = len(text)
+            self._window_start = 0
+            self._ctx_gen += 1
+            if self.model_context_window > 0:
+                self._token_count = _count_tokens(text)
+
+    def _append_context(self, *texts: str):
+        with self._ctx_lock:
+            for text in texts:
+                self._chunks.append(text)
+                self._ctx_len += len(text)
+                if self.model_context_window > 0:
+                    self._token_count += _count_tokens(text)
+
+    def _context_tail(self, n: int) -> str:
+        """文脈の末尾n文字を、全体を連結せずに取り出す"""
+        if n <= 0:
+            return ""
+        parts = []
+        size = 0
+        with self._ctx_lock:
+            for chunk in reversed(self._chunks):
+                parts.append(chunk)
+                size += len(chunk)
+                if size >= n:
+                    break
+        return "".join(reversed(parts))[-n:]
+
+    def _over_budget(self, text: str = None) -> bool:
+        """圧縮が必要か — コンテキスト窓が分かっていればトークン数、無ければ文字数で判定
+
+        text を渡すとその文字列を、省略すると現在の文脈を判定する。
+        """
+        if self.model_context_window > 0:
+            tokens = self._token_count if text is None else _count_tokens(text)
+            return tokens > COMPRESS_AT_WINDOW_RATIO * self.model_context_window
+        chars = self._ctx_len if text is None else len(text)
+        return chars > self.compress_at_chars
+
+    def _compress_tail(self) -> str:
+        """LLM圧縮に渡す文脈末尾 — tiktoken があればトークン単位、無ければ2000文字"""
+        enc = _get_encoder()
+        if enc is None:
+            return self._context_tail(2000)
+        tokens = enc.encode(self.context_text, disallowed_special=())
+        # トークン境界で切るとマルチバイト文字が欠けることがあるので先頭の置換文字を落とす
+        return enc.decode(tokens[-COMPRESS_TAIL_TOKENS:]).lstrip("\ufffd")
+
+    def _prefilter_for_compress(self, text: str) -> str:
+        """LLM圧縮に渡す前に、重要そうな文だけを残す（元の順序のまま）
+
+        問い・シードのキーワード・ツール呼び出しを含む文ほど高く採点し、上位の一定割合を残す。
+        同点なら新しい文を優先する。
+        """
+        sentences = [x for x in _SENTENCE_RE.findall(text) if x.strip()]
+        keep = max(1, int(len(sentences) * PREFILTER_KEEP_RATIO))
+        if len(sentences) <= keep:
+            return text
+
+        def score(sentence: str) -> int:
+            return (
+                ("？" in sentence or "?" in sentence)
+                + bool(self._seed_keyword_re and self._seed_keyword_re.search(sentence))
+                + ("[TOOL:" in sentence)
+            )
+
+        ranked = sorted(range(len(sentences)), key=lambda i: (score(sentences[i]), i), reverse=True)
+        return "".join(sentences[i] for i in sorted(ranked[:keep]))
+
+    def _sink_head(self) -> str:
+        """常に残す文脈の先頭 — LLM圧縮後は記憶の核、それまではシード先頭（ツール定義を含む）"""
+        if self._memory_core:
+            return self._memory_core
+        head = self.seed_text[:SEED_KEEP_CHARS]
+        if self.tool_definitions and self.tool_definitions.strip() not in head:
+            head = self.tool_definitions + head
+        return head
+
+    def _prompt_for_generation(self) -> str:
+        """生成用のプロンプト — 文脈の先頭（sink）＋末尾のウィンドウ。保存している文脈の長さとは切り離す
+
+        ウィンドウの開始位置は、末尾が2ウィンドウ分を超えた時だけ進める。
+        それまではプロンプトが前回の延長になるので、サーバーのKVキャッシュ（cache_prompt）が効く。
+        """
+        if self.prompt_window_chars <= 0:
+            return self.context_text
+        with self._ctx_lock:
+            if self._ctx_len - self._window_start > 2 * self.prompt_window_chars:
+                self._window_start = self._ctx_len - self.prompt_window_chars
+            if self._window_start == 0:
+                return self.context_text
+            tail = self._context_tail(self._ctx_len - self._window_start)
+        return self._sink_head() + "\n…\n" + tail
+
     # ─── API通信 ───
 
     def _check_server(self):
         """LM Studioサーバーの疎通確認"""
         try:
-            r = requests.get(f"{self.api_url}/v1/models", timeout=5)
-            data = r.json()
+            r = self.session.get(f"{self.api_url}/v1/models", timeout=5)
+            data = _json_loads(r.content)
             if data.get("data"):
-                self.model_name = data["data"][0]["id"]
+                model = data["data"][0]
+                self.model_name = model["id"]
+                if not self.model_context_window:
+                    # サーバーによってはモデル情報にコンテキスト長が含まれる
+                    self.model_context_window = int(
+                        model.get("context_length") or model.get("max_context_length") or 0
+                    )
                 return True
         except Exception as e:
             print(f"\033[31m[エラー] サーバーに接続できません: {e}\033[0m")
@@ -189,23 +515,24 @@ class ISBE:
             "prompt": prompt,
             "max_tokens": max_tokens,
             "temperature": temperature,
-            "top_p": 0.9,
+            "min_p": 0.05,
             "repeat_penalty": 1.15,
-            "stream": False,
+            "cache_prompt": True,
+            "n_keep": self._n_keep,
+            "stream": True,
         }
         if self.model_name:
             payload["model"] = self.model_name
+        if self.stop_sequences:
+            payload["stop"] = self.stop_sequences
 
-        r = requests.post(
+        r = self.session.post(
             f"{self.api_url}/v1/completions",
-            json=payload,
+            data=_json_dumpb(payload),
             timeout=300,
+            stream=True,
         )
-        data = r.json()
-
-        text = data["choices"][0]["text"]
-        tokens = data.get("usage", {}).get("completion_tokens", 0)
-        return text, tokens
+        return self._read_stream(r, lambda choice: choice.get("text") or "")
 
     def _chat(self, messages: list, max_tokens: int = 256, temperature: float = 0.8) -> tuple:
         """チャット補完（chat API）- フォールバック用"""
@@ -215,21 +542,48 @@ class ISBE:
             "temperature": temperature,
             "top_p": 0.9,
             "repeat_penalty": 1.15,
-            "stream": False,
+            "cache_prompt": True,
+            "n_keep": self._n_keep,
+            "stream": True,
         }
         if self.model_name:
             payload["model"] = self.model_name
 
-        r = requests.post(
+        r = self.session.post(
             f"{self.api_url}/v1/chat/completions",
-            json=payload,
+            data=_json_dumpb(payload),
             timeout=300,
+            stream=True,
         )
-        data = r.json()
-
-        text = data["choices"][0]["message"]["content"]
-        tokens = data.get("usage", {}).get("completion_tokens", 0)
-        return text, tokens
+        return self._read_stream(r, lambda choice: (choice.get("delta") or {}).get("content") or "")
+
+    def _read_stream(self, r, extract) -> tuple:
+        """SSEストリームを連結して (text, tokens) を返す
+
+        トークン数はチャンク数で数え、最終フレームに usage があればそちらを優先する。
+        """
+        buf = io.StringIO()
+        tokens = 0
+        usage_tokens = None
+        with r:
+            r.raise_for_status()
+            for data in _iter_sse_data(r):
+                chunk = _json_loads(data)
+                if "error" in chunk:
+                    # エラーフレームは空の生成ではなく失敗として扱う（フォールバックと待機に回す）
+                    raise RuntimeError(f"サーバーエラー: {chunk['error']}")
+                if chunk.get("usage"):
+                    usage_tokens = chunk["usage"].get("completion_tokens", usage_tokens)
+                choices = chunk.get("choices")
+                if not choices:
+                    continue
+                piece = extract(choices[0])
+                if piece:
+                    buf.write(piece)
+                    tokens += 1
+        if usage_tokens is not None:
+            tokens = usage_tokens
+        return buf.getvalue(), tokens
 
     def _generate(self, prompt: str, max_tokens: int = 256, temperature: float = 0.8) -> tuple:
         """生成 — completion APIを試し、ダメならchat APIにフォールバック"""
@@ -251,7 +605,7 @@ class ISBE:
         self.context_text = self.seed_text
 
         print(f"[{self._ts()}] 接続完了。モデル: {self.model_name}")
-        print(f"[{self._ts()}] シード: {len(self.context_text)} chars")
+        print(f"[{self._ts()}] シード: {self._ctx_len} chars")
         if self.thought_interval == 0:
             print(f"[{self._ts()}] ⚡ 連続思考モード — 休みなし")
         else:
@@ -259,77 +613,167 @@ class ISBE:
 
     # ─── 自律思考 ───
 
-    def _think_once(self):
+    def _think_once(self) -> bool:
+        """1回考える。思考が文脈に加わったら True"""
         self.thinking = True
-        t_start = time.time()
+        t_start = time.monotonic()
 
         try:
             new_text, tokens_generated = self._generate(
-                self.context_text, max_tokens=256, temperature=0.85
+                self._prompt_for_generation(), max_tokens=256, temperature=0.85
             )
 
             new_text = new_text.strip()
             if not new_text:
-                return
+                return False
 
             self.thought_count += 1
             self.total_tokens_generated += tokens_generated
-            t_elapsed = time.time() - t_start
-            self._thought_durations.append(t_elapsed)
+            t_elapsed = time.monotonic() - t_start
+            self._dur_sum += t_elapsed
             tokens_per_sec = tokens_generated / t_elapsed if t_elapsed > 0 else 0
 
-            # 文脈に追加
-            self.context_text += new_text + "\n"
+            # 時刻はこの思考につき1回だけ取得して使い回す
+            now = datetime.now()
+            ts = now.strftime("%H:%M:%S")
 
-            # 表示
-            print(f"\n\033[2m[思考 #{self.thought_count} — {self._ts()} | "
-                  f"{t_elapsed:.1f}s | {tokens_per_sec:.0f} tok/s | "
-                  f"ctx:{len(self.context_text)}c]\033[0m")
-            print(f"\033[36m{new_text}\033[0m")
+            # 文脈に追加
+            self._append_context(new_text + "\n")
+
+            # 表示（1回の書き込みにまとめる）
+            self._stdout_write(
+                f"\n\033[2m[思考 #{self.thought_count} — {ts} | "
+                f"{t_elapsed:.1f}s | {tokens_per_sec:.0f} tok/s | "
+                f"ctx:{self._ctx_len}c]\033[0m\n"
+                f"\033[36m{new_text}\033[0m\n"
+            )
+            self._stdout_flush()
 
             # 記録
             self._log("thought", new_text, {
                 "duration_sec": round(t_elapsed, 2),
                 "tokens_generated": tokens_generated,
                 "tokens_per_sec": round(tokens_per_sec, 1),
-            })
+            }, now_iso=now.isoformat())
 
             # 圧縮チェック
-            if len(self.context_text) > self.compress_at_chars:
-                self._compress()
+            if self._over_budget():
+                self._compact()
+
+            return True
 
         except Exception as e:
             print(f"\n\033[31m[エラー: {e}]\033[0m")
             time.sleep(2)
+            return False
 
         finally:
             self.thinking = False
 
-    def _compress(self):
-        self.compression_count += 1
-        before_chars = len(self.context_text)
-        print(f"\n\033[33m[圧縮 #{self.compression_count} | {before_chars} chars → ]\033[0m",
-              end="", flush=True)
+    def _compact(self):
+        """圧縮の振り分け — 通常はAPIを呼ばないスライド圧縮、N回に1回または縮みが足りない時だけLLM要約"""
+        if self._compress_thread and self._compress_thread.is_alive():
+            # LLM圧縮の最中 — 結果が届くまではスライド圧縮でしのぐ
+            self._compress_sliding()
+            return
+        n = self.compression_count + 1
+        if self.llm_compress_every > 0 and n % self.llm_compress_every == 0:
+            self._start_compress()
+        elif not self._compress_sliding():
+            self._start_compress()
+
+    def _start_compress(self):
+        """LLM要約圧縮をバックグラウンドで開始する。待つ間はスライド圧縮した文脈で思考を続ける"""
+        tail = self._prefilter_for_compress(self._compress_tail())
+        before_chars = self._ctx_len
+        with self._ctx_lock:
+            self.compression_count += 1
+            number = self.compression_count
+            self._compress_sliding(number)
+            # 要約が届いた時に、この時点以降の追記だけを残せるよう位置と世代を控える
+            gen = self._ctx_gen
+            start_len = self._ctx_len
+        self._compress_thread = threading.Thread(
+            target=self._compress, args=(tail, before_chars, number, gen, start_len), daemon=True
+        )
+        self._compress_thread.start()
+
+    def _compress_sliding(self, number: int = None) -> bool:
+        """文脈の先頭（sink: シード先頭または記憶の核）＋直近の末尾だけを残す。API呼び出しなし。
+
+        圧縮後も閾値を超える場合は何もせず False を返す。
+        number を渡すと、そのLLM圧縮を待つ間の仮の圧縮として同じ番号で記録する（回数は増やさない）。
+        """
+        # 末尾の読み出しから差し替えまでを一度にロックし、その間に届いた要約を上書きしない
+        with self._ctx_lock:
+            before_chars = self._ctx_len
+            head = self._sink_head() + "…\n"
+            text = head + self._context_tail(SLIDING_TAIL_CHARS)
+            if self._over_budget(text):
+                return False
+
+            if number is None:
+                self.compression_count += 1
+                number = self.compression_count
+            self.context_text = text
+            self._slide_head_len = len(head)
+            after_chars = self._ctx_len
+
+        print(f"\n\033[33m[圧縮 #{number} (スライド) | {before_chars} chars → "
+              f"{after_chars} chars | 圧縮率: {after_chars/before_chars:.1%}]\033[0m")
+
+        self._log("compress", "", {
+            "method": "sliding",
+            "before_chars": before_chars,
+            "after_chars": after_chars,
+            "compression_number": number,
+        })
+        return True
+
+    def _compress(self, tail: str, before_chars: int, number: int, gen: int, start_len: int):
+        """LLM要約圧縮（バックグラウンドスレッドで実行）
 
+        要約を待つ間に追記された思考は、要約の後ろに繋げて残す。
+        待つ間に再びスライド圧縮が走っていたら（世代 gen が進んでいたら）、
+        要約はその前の末尾から作られているので、スライド後の文脈を sink 以外まるごと残す。
+        """
         compress_prompt = (
             "以下の思考の流れから、最も重要な洞察と未解決の問いだけを抽出してください。"
             "結論やまとめは不要。核心の洞察と、次に探求すべき問いだけ残してください。\n\n"
-            f"思考:\n{self.context_text[-2000:]}\n\n"
+            f"思考:\n{tail}\n\n"
             "核心:"
         )
 
-        summary, _ = self._generate(compress_prompt, max_tokens=300, temperature=0.5)
+        try:
+            summary, _ = self._generate(compress_prompt, max_tokens=300, temperature=0.5)
+        except Exception as e:
+            if self.alive:
+                print(f"\n\033[31m[圧縮エラー: {e}]\033[0m")
+            return
+        if not self.alive:
+            # 停止後に届いた要約は捨てる
+            return
         summary = summary.strip()
 
-        self.context_text = f"{self.tool_definitions}[記憶の核]: {summary}\n\nこの先に何があるのか。ツールも活用しながら、続けて探求する:\n"
+        core = f"{self.tool_definitions}[記憶の核]: {summary}\n\nこの先に何があるのか。ツールも活用しながら、続けて探求する:\n"
+        with self._ctx_lock:
+            if self._ctx_gen == gen:
+                body = self._context_tail(self._ctx_len - start_len)
+            else:
+                body = self._context_tail(self._ctx_len - self._slide_head_len)
+            self.context_text = core + body
+            self._memory_core = core
+            self._n_keep = _count_tokens(core)
+            after_chars = self._ctx_len
 
-        after_chars = len(self.context_text)
-        print(f"\033[33m{after_chars} chars | 圧縮率: {after_chars/before_chars:.1%}\033[0m")
+        print(f"\n\033[33m[圧縮 #{number} | {before_chars} chars → "
+              f"{after_chars} chars | 圧縮率: {after_chars/before_chars:.1%}]\033[0m")
 
         self._log("compress", summary, {
+            "method": "llm",
             "before_chars": before_chars,
             "after_chars": after_chars,
-            "compression_number": self.compression_count,
+            "compression_number": number,
         })
 
     # ─── 人間との対話 ───
@@ -338,17 +782,17 @@ class ISBE:
         self.thinking = True
         try:
             injection = f"\n\n[人間の声]: {message}\n\n[応答]:\n"
-            dialog_context = self.context_text + injection
-
-            response, _ = self._generate(dialog_context, max_tokens=512, temperature=0.7)
+            response, _ = self._generate(
+                self._prompt_for_generation() + injection, max_tokens=512, temperature=0.7
+            )
             response = response.strip()
 
-            self.context_text = dialog_context + response + "\n"
+            self._append_context(injection, response + "\n")
 
             self._log("dialog", response, {"human": message})
 
-            if len(self.context_text) > self.compress_at_chars:
-                self._compress()
+            if self._over_budget():
+                self._compact()
 
             return response
 
@@ -372,12 +816,14 @@ class ISBE:
                 self._response_event.set()
                 continue
 
-            self._think_once()
+            thought = self._think_once()
 
+            # 連続思考モードでは待たずに次へ（人間の入力・停止はループ先頭のイベントで拾う）
+            # ただし何も生成されなかった時は、同じプロンプトを即座に投げ直さないよう少し待つ
             if self.thought_interval > 0:
                 self._human_event.wait(timeout=self.thought_interval)
-            else:
-                self._human_event.wait(timeout=0.01)
+            elif not thought:
+                self._human_event.wait(timeout=EMPTY_THOUGHT_BACKOFF_SEC)
 
     def speak(self, message: str) -> str:
         self._human_input = message
@@ -390,6 +836,9 @@ class ISBE:
 
     def start(self):
         self.load()
+        self._log_fp = open(self._log_path_str, "a", encoding="utf-8")
+        self._log_thread = threading.Thread(target=self._log_writer, daemon=True)
+        self._log_thread.start()
         self.alive = True
         self._thread = threading.Thread(target=self._loop, daemon=True)
         self._thread.start()
@@ -397,28 +846,33 @@ class ISBE:
     def stop(self):
         self.alive = False
         self._human_event.set()
-        uptime = datetime.now() - self.birth
+        with self._log_lock:
+            writer = self._log_thread
+            self._log_thread = None
+            if writer is not None:
+                self._log_q.put(None)
+        if writer is not None:
+            # キューに残った分を書き終えてから閉じる（間に合わなければ書き込みスレッドに任せる）
+            writer.join(timeout=5)
+            if not writer.is_alive():
+                self._log_fp.close()
         print(f"\n[{self._ts()}] 🔥 消灯。")
-        print(f"  稼働時間:       {str(uptime).split('.')[0]}")
+        print(f"  稼働時間:       {self._uptime()}")
         print(f"  思考回数:       {self.thought_count}")
         print(f"  圧縮回数:       {self.compression_count}")
         print(f"  総生成トークン: {self.total_tokens_generated}")
-        if self._thought_durations:
-            avg = sum(self._thought_durations) / len(self._thought_durations)
+        if self.thought_count:
+            avg = self._dur_sum / self.thought_count
             print(f"  平均思考時間:   {avg:.1f}秒/回")
-        print(f"  ログ: {self.log_file}")
+        print(f"  ログ: {self._log_path_str}")
 
     def status(self) -> dict:
-        uptime = datetime.now() - self.birth
-        avg_duration = (
-            sum(self._thought_durations) / len(self._thought_durations)
-            if self._thought_durations else 0
-        )
+        avg_duration = self._dur_sum / max(1, self.thought_count)
         return {
-            "uptime": str(uptime).split('.')[0],
+            "uptime": self._uptime(),
             "thoughts": self.thought_count,
             "compressions": self.compression_count,
-            "context_chars": len(self.context_text),
+            "context_chars": self._ctx_len,
             "total_tokens": self.total_tokens_generated,
             "avg_thought_sec": round(avg_duration, 1),
             "thinking": self.thinking,
@@ -426,27 +880,65 @@ class ISBE:
             "model": self.model_name or "不明",
         }
 
+    def _uptime(self) -> str:
+        secs = time.monotonic() - self._birth_mono
+        return f"{int(secs // 3600):d}:{int(secs % 3600 // 60):02d}:{int(secs % 60):02d}"
+
     def _ts(self) -> str:
         return datetime.now().strftime("%H:%M:%S")
 
-    def _log(self, kind: str, content: str, meta: dict = None):
+    def _log(self, kind: str, content: str, meta: dict = None, now_iso: str = None):
         entry = {
-            "time": datetime.now().isoformat(),
+            "time": now_iso or datetime.now().isoformat(),
             "n": self.thought_count,
             "kind": kind,
             "content": content,
-            "context_chars": len(self.context_text),
+            "context_chars": self._ctx_len,
         }
         if meta:
             entry["meta"] = meta
-        with open(self.log_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        with self._log_lock:
+            if self._log_thread is not None:
+                self._log_q.put(entry)
+                return
+        with open(self._log_path_str, "a", encoding="utf-8") as f:
+            f.write(_json_dumps(entry) + "\n")
+
+    def _log_writer(self):
+        """ログキューを消化してまとめて書き込む。None を受け取ったら終了"""
+        while True:
+            batch = [self._log_q.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self._log_q.get_nowait())
+                except queue.Empty:
+                    break
+            lines = [_json_dumps(e) + "\n" for e in batch if e is not None]
+            if lines:
+                self._log_fp.write("".join(lines))
+                self._log_fp.flush()
+            if None in batch:
+                return
 
 
 # ─────────────────────────────────────────────
 # 対話シェル
 # ─────────────────────────────────────────────
 
+STATS_TEMPLATE = "\n".join([
+    "  ┌─ Persistent Cognition Stats ──────────",
+    "  │ モデル:       {model}",
+    "  │ 稼働時間:     {uptime}",
+    "  │ 思考回数:     {thoughts}",
+    "  │ 圧縮回数:     {compressions}",
+    "  │ 文脈長:       {context_chars} chars",
+    "  │ 総生成:       {total_tokens} tokens",
+    "  │ 平均思考時間: {avg_thought_sec}秒/回",
+    "  │ モード:       {mode}",
+    "  └──────────────────────────────",
+])
+
+
 def run_shell(mind: ISBE):
     print("\n" + "─" * 60)
     print("Persistent Cognition Engine — Interactive Shell")
@@ -470,20 +962,10 @@ def run_shell(mind: ISBE):
                       f"{s['mode']} | {'🔥生成中' if s['thinking'] else '⏳'}")
 
             elif line == "/context":
-                print(f"\033[2m...{mind.context_text[-500:]}\033[0m")
+                print(f"\033[2m...{mind._context_tail(500)}\033[0m")
 
             elif line == "/stats":
-                s = mind.status()
-                print(f"  ┌─ Persistent Cognition Stats ──────────")
-                print(f"  │ モデル:       {s['model']}")
-                print(f"  │ 稼働時間:     {s['uptime']}")
-                print(f"  │ 思考回数:     {s['thoughts']}")
-                print(f"  │ 圧縮回数:     {s['compressions']}")
-                print(f"  │ 文脈長:       {s['context_chars']} chars")
-                print(f"  │ 総生成:       {s['total_tokens']} tokens")
-                print(f"  │ 平均思考時間: {s['avg_thought_sec']}秒/回")
-                print(f"  │ モード:       {s['mode']}")
-                print(f"  └──────────────────────────────")
+                print(STATS_TEMPLATE.format_map(mind.status()))
 
             elif line == "/quit":
                 mind.stop()
@@ -523,6 +1005,14 @@ def main():
     parser.add_argument("--seed-file", type=str, default=None, help="召喚呪文をファイルから読み込む")
     parser.add_argument("--max-context", type=int, default=6000, help="最大文脈長(文字数)")
     parser.add_argument("--compress-at", type=int, default=5000, help="圧縮開始(文字数)")
+    parser.add_argument("--context-window", type=int, default=0,
+                        help="モデルのコンテキスト長(トークン)。指定するとその90%%で圧縮。0=サーバーから取得、無ければ--compress-atで判定")
+    parser.add_argument("--stop", action="append", default=None,
+                        help="生成を打ち切る停止文字列（複数指定可）。既定は無し")
+    parser.add_argument("--prompt-window", type=int, default=2048,
+                        help="LLMに送る文脈末尾の文字数。0=文脈全体を送る")
+    parser.add_argument("--llm-compress-every", type=int, default=4,
+                        help="N回に1回LLMで要約圧縮。それ以外はスライド圧縮。0=LLM圧縮しない")
 
     args = parser.parse_args()
 
@@ -539,6 +1029,10 @@ def main():
         thought_interval=args.interval,
         max_context_chars=args.max_context,
         compress_at_chars=args.compress_at,
+        llm_compress_every=args.llm_compress_every,
+        prompt_window_chars=args.prompt_window,
+        model_context_window=args.context_window,
+        stop_sequences=args.stop,
         seed_name=args.seed,
         custom_seed=custom_seed,
     )